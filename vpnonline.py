@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-import collections
-import io
+import functools
+import json
+import mmap
 import multiprocessing
 import os
 import os.path
@@ -10,16 +11,33 @@ import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 import urllib.request
 import zipfile
 
 
+if sys.stdout.isatty():
+    try:
+        import colorama; colorama.init()
+        HIGHLIGHT_STYLE, HIGHLIST_RESET = colorama.Fore.RED, colorama.Fore.RESET
+
+    except:
+        HIGHLIGHT_STYLE, HIGHLIST_RESET = '[', ']'
+
+else:
+    HIGHLIGHT_STYLE, HIGHLIST_RESET = '', ''
+
 try:
-    import colorama; colorama.init()
-    HIGHLIGHT_STYLE, HIGHLIST_RESET = colorama.Fore.RED, colorama.Fore.RESET
+    import ahocorasick
 
-except:
-    HIGHLIGHT_STYLE, HIGHLIST_RESET = '[', ']'
+except ImportError:
+    ahocorasick = None
+
+try:
+    import hyperscan
+
+except ImportError:
+    hyperscan = None
 
 
 def current_user():
@@ -41,32 +59,114 @@ DEFINITIONS_DIRECTORY_PATH = os.path.join(CONFIGURATION_DIRECTORY_PATH, DEFINITI
 CREDENTIALS_FILE_NAME = 'credentials.txt'
 CREDENTIALS_FILE_PATH = os.path.join(CONFIGURATION_DIRECTORY_PATH, CREDENTIALS_FILE_NAME)
 
+INDEX_FILE_NAME = 'index.json'
+INDEX_FILE_PATH = os.path.join(CONFIGURATION_DIRECTORY_PATH, INDEX_FILE_NAME)
+
 # https://github.com/kylemanna/docker-openvpn/issues/330#issuecomment-346697599
 BROKEN_DEFINITION_OPTIONS = [
     'block-outside-dns'
 ]
+BROKEN_DEFINITION_OPTIONS_REGEX = re.compile(b'|'.join(re.escape(option.encode()) for option in BROKEN_DEFINITION_OPTIONS))
 
 
 def list_files(directory_path, extensions):
-    for root_path, _, file_paths in os.walk(directory_path):
-        for file_path in file_paths:
-            _, file_extension = os.path.splitext(file_path)
+    extensions = tuple(extensions)
 
-            if file_extension in extensions:
-                yield root_path, file_path
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from list_files(entry.path, extensions)
+
+            elif entry.name.lstrip('.').endswith(extensions):
+                yield directory_path, entry.name
 
 def or_pattern(expressions):
-    return '|'.join(map(str.lower, expressions))
+    return '|'.join(map(re.escape, expressions))
+
+@functools.lru_cache(maxsize=64)
+def or_regex(expressions, flags=0):
+    return re.compile(or_pattern(expressions), flags)
+
+@functools.lru_cache(maxsize=64)
+def lower_expressions(expressions):
+    return tuple(dict.fromkeys(expression for expression in map(str.lower, expressions) if expression))
+
+def expressions_automaton(expressions):
+    automaton = ahocorasick.Automaton()
+
+    for i, expression in enumerate(expressions):
+        automaton.add_word(expression, (i, len(expression)))
+
+    automaton.make_automaton()
+    return automaton
+
+def expressions_database(expressions):
+    database = hyperscan.Database()
+    database.compile(
+        expressions=[expression.encode() for expression in expressions],
+        ids=list(range(len(expressions))),
+        elements=len(expressions),
+        literal=True)
+
+    return database
+
+def select_spans(matches, expressions_count):
+    seen_mask = 0
+    spans = []
+    last_stop = 0
 
-def and_pattern(expressions):
-    return ''.join(f'(?=.*{expression})' for expression in map(str.lower, expressions))
+    for i, start, stop in sorted(matches, key=lambda match: (match[1], match[0])):
+        seen_mask |= 1 << i
 
-def highlight_expressions(text, expressions, style, reset):
-    regex = re.compile(or_pattern(expressions))
+        if start >= last_stop:
+            spans.append((start, stop))
+            last_stop = stop
+
+    if seen_mask == (1 << expressions_count) - 1:
+        return spans
+
+def original_spans(text, lowered_text, spans, expressions):
+    if spans is None or len(lowered_text) == len(text):
+        return spans
+
+    return list(map(re.Match.span, or_regex(expressions, re.IGNORECASE).finditer(text)))
+
+def match_expressions(text, automaton, expressions):
+    lowered_text = text.lower()
+    matches = ((i, end + 1 - length, end + 1) for end, (i, length) in automaton.iter(lowered_text))
+    return original_spans(text, lowered_text, select_spans(matches, len(expressions)), expressions)
+
+def scan_expressions(text, database, expressions, expressions_lengths):
+    lowered_text = text.lower()
+    text_bytes = lowered_text.encode()
+    matches = []
+
+    def on_match(i, _, stop, flags, context):
+        matches.append((i, stop - expressions_lengths[i], stop))
+
+    database.scan(text_bytes, match_event_handler=on_match)
+
+    if not lowered_text.isascii():
+        matches = [(i, len(text_bytes[:start].decode()), len(text_bytes[:stop].decode())) for i, start, stop in matches]
+
+    return original_spans(text, lowered_text, select_spans(matches, len(expressions)), expressions)
+
+@functools.lru_cache(maxsize=64)
+def expressions_matcher(expressions):
+    if hyperscan is not None:
+        database = expressions_database(expressions)
+        expressions_lengths = [len(expression.encode()) for expression in expressions]
+        return functools.partial(scan_expressions, database=database, expressions=expressions, expressions_lengths=expressions_lengths)
+
+    if ahocorasick is not None:
+        automaton = expressions_automaton(expressions)
+        return functools.partial(match_expressions, automaton=automaton, expressions=expressions)
+
+def highlight_spans(text, spans, style, reset):
     text_parts = []
     last_stop = 0
 
-    for start, stop in map(re.Match.span, regex.finditer(text.lower())):
+    for start, stop in spans:
         text_parts.append(text[last_stop:start])
         text_parts.append(style)
         
@@ -79,6 +179,12 @@ def highlight_expressions(text, expressions, style, reset):
 
     return ''.join(text_parts)
 
+def highlight_expressions(text, regex, style, reset):
+    if not style and not reset:
+        return text
+
+    return highlight_spans(text, map(re.Match.span, regex.finditer(text)), style, reset)
+
 
 def write_credentials(credentials_path, user_name, user_pass):
     with open(credentials_path, 'w') as ofs:
@@ -87,66 +193,161 @@ def write_credentials(credentials_path, user_name, user_pass):
 
     os.chmod(credentials_path, CONFIGURATION_DIRECTORY_PERMISSIONS)    
 
-def fix_broken_definition(file_path, broken_options):
-    with open(file_path, 'r') as ifs:
-        definition_lines = ifs.readlines()
+def fix_broken_definition(file_path, broken_options_regex):
+    with open(file_path, 'rb') as ifs:
+        if os.fstat(ifs.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(ifs.fileno(), 0, access=mmap.ACCESS_READ) as definition:
+            if not broken_options_regex.search(definition):
+                return
 
-        fixed_definition_lines = []
+            definition_lines = definition[:].splitlines(keepends=True)
 
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(file_path), delete=False) as ofs:
         for definition_line in definition_lines:
-            if all(broken_option not in definition_line for broken_option in broken_options):
-                fixed_definition_lines.append(definition_line)
+            if not broken_options_regex.search(definition_line):
+                ofs.write(definition_line)
 
-    if len(fixed_definition_lines) < len(definition_lines):
-        with open(file_path, 'w') as ofs:
-            ofs.writelines(fixed_definition_lines)
+    shutil.copymode(file_path, ofs.name)
+    os.replace(ofs.name, file_path)
 
-def fix_broken_definitions(start_path, extensions, broken_options):
-    for root_path, file_path in list_files(start_path, extensions):
-        definition_path = os.path.join(root_path, file_path)
-        fix_broken_definition(definition_path, broken_options)
+def fix_broken_definitions(start_path, extensions, broken_options_regex):
+    definition_paths = [os.path.join(root_path, file_path) for root_path, file_path in list_files(start_path, extensions)]
+
+    with multiprocessing.Pool() as pool:
+        pool.map(functools.partial(fix_broken_definition, broken_options_regex=broken_options_regex), definition_paths, chunksize=16)
 
 def fetch_definitions(definitions_url):
     request = urllib.request.Request(url=definitions_url, headers={'User-Agent': 'Mozilla/5.0'})
-    response = urllib.request.urlopen(request)
-    return io.BytesIO(response.read())
+    definitions_file = tempfile.TemporaryFile()
+
+    with urllib.request.urlopen(request) as response:
+        shutil.copyfileobj(response, definitions_file, length=64 * 1024)
 
-def extract_definitions(definitions_file, definitions_directory, extensions, skip_subtrees=True):       
+    definitions_file.seek(0)
+    return definitions_file
+
+def extract_definitions(definitions_file, definitions_directory, extensions, skip_subtrees=True):
     with zipfile.ZipFile(definitions_file, 'r') as zip_ifs:
-        for zip_file in zip_ifs.filelist:
-            if skip_subtrees:
-                zip_file.filename = os.path.basename(zip_file.filename)
-            _, zip_file_extension = os.path.splitext(zip_file.filename)
+        zip_files = [zip_file for zip_file in zip_ifs.infolist() if os.path.splitext(zip_file.filename)[1] in extensions]
+
+        if not skip_subtrees:
+            zip_ifs.extractall(definitions_directory, members=zip_files)
+            return
+
+        for zip_file in zip_files:
+            definition_path = os.path.join(definitions_directory, os.path.basename(zip_file.filename))
+
+            with zip_ifs.open(zip_file) as ifs, open(definition_path, 'wb') as ofs:
+                shutil.copyfileobj(ifs, ofs, length=64 * 1024)
+
+def directory_mtimes(directory_path):
+    mtimes = {directory_path: os.stat(directory_path).st_mtime_ns}
+
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                mtimes.update(directory_mtimes(entry.path))
+
+    return mtimes
+
+def read_index(index_path, definitions_directory, extensions):
+    try:
+        with open(index_path, 'r') as ifs:
+            index = json.load(ifs)
+
+        mtimes = index['mtimes']
+
+        if index['extensions'] != sorted(extensions):
+            return
+
+        if definitions_directory in mtimes and all(os.stat(directory_path).st_mtime_ns == mtime_ns for directory_path, mtime_ns in mtimes.items()):
+            return [tuple(definition_path) for definition_path in index['definitions']]
+
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+def write_index(index_path, extensions, mtimes, definition_paths):
+    ofs = None
+
+    try:
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(index_path), delete=False) as ofs:
+            json.dump({'extensions': sorted(extensions), 'mtimes': mtimes, 'definitions': definition_paths}, ofs)
+
+        os.replace(ofs.name, index_path)
+
+    except OSError:
+        if ofs is not None:
+            try:
+                os.unlink(ofs.name)
+
+            except OSError:
+                pass
 
-            if zip_file_extension in extensions:
-                zip_ifs.extract(zip_file, definitions_directory)
+def index_definitions(definitions_directory, extensions, index_path):
+    definition_paths = read_index(index_path, definitions_directory, extensions)
 
-def index_definitions(definitions_directory, extensions):
-    definition_paths = sorted(list_files(definitions_directory, extensions))
-    return collections.OrderedDict(enumerate(definition_paths, 1))       
+    if definition_paths is None:
+        mtimes = directory_mtimes(definitions_directory)
+        definition_paths = sorted(list_files(definitions_directory, extensions))
+        write_index(index_path, extensions, mtimes, definition_paths)
+
+    return definition_paths
                 
 def filter_definitions(indexed_definitions, expressions):
-    regex = re.compile(and_pattern(expressions))
-    return collections.OrderedDict(
+    expressions = lower_expressions(tuple(expressions))
+    return [
         (i, (x, y))
-        for i, (x, y) in indexed_definitions.items()
-        if regex.match(y.lower()))
+        for i, (x, y) in indexed_definitions
+        for y_lower in (y.lower(),)
+        if all(expression in y_lower for expression in expressions)]
 
 def highlight_definitions(indexed_definitions, expressions):
-    return collections.OrderedDict(
-        (i, (x, highlight_expressions(y, expressions, HIGHLIGHT_STYLE, HIGHLIST_RESET)))
-        for i, (x, y) in indexed_definitions.items())
+    expressions = lower_expressions(tuple(expressions))
+
+    if not expressions:
+        return list(indexed_definitions)
+
+    regex = or_regex(expressions, re.IGNORECASE)
+    return [
+        (i, (x, highlight_expressions(y, regex, HIGHLIGHT_STYLE, HIGHLIST_RESET)))
+        for i, (x, y) in indexed_definitions]
+
+def search_definitions(indexed_definitions, expressions):
+    if not HIGHLIGHT_STYLE and not HIGHLIST_RESET:
+        return filter_definitions(indexed_definitions, expressions)
+
+    expressions = lower_expressions(tuple(expressions))
+
+    if not expressions:
+        return list(indexed_definitions)
+
+    matcher = expressions_matcher(expressions)
+
+    if matcher is None:
+        filtered_indexed_definitions = filter_definitions(indexed_definitions, expressions)
+        return highlight_definitions(filtered_indexed_definitions, expressions)
+
+    searched_indexed_definitions = []
+
+    for i, (x, y) in indexed_definitions:
+        spans = matcher(y)
+
+        if spans is not None:
+            searched_indexed_definitions.append((i, (x, highlight_spans(y, spans, HIGHLIGHT_STYLE, HIGHLIST_RESET))))
+
+    return searched_indexed_definitions
 
 
 def prepare_definitions():
     definitions_file = fetch_definitions(DEFINITIONS_URL)
 
     extract_definitions(definitions_file, DEFINITIONS_DIRECTORY_PATH, DEFINITION_EXTENSIONS)
-    fix_broken_definitions(DEFINITIONS_DIRECTORY_PATH, DEFINITION_EXTENSIONS, BROKEN_DEFINITION_OPTIONS) 
+    fix_broken_definitions(DEFINITIONS_DIRECTORY_PATH, DEFINITION_EXTENSIONS, BROKEN_DEFINITION_OPTIONS_REGEX)
 
 def print_definitions(indexed_definitions):
-    for i, (_, file_path) in indexed_definitions.items():
-        print(f'{i:<3} {file_path}')
+    sys.stdout.write(''.join(f'{i:<3} {file_path}\n' for i, (_, file_path) in indexed_definitions))
 
 
 if __name__ == '__main__':
@@ -195,31 +396,29 @@ if __name__ == '__main__':
         os.mkdir(DEFINITIONS_DIRECTORY_PATH)
         prepare_definitions()
 
-    indexed_definitions = index_definitions(DEFINITIONS_DIRECTORY_PATH, DEFINITION_EXTENSIONS)
+    definitions = index_definitions(DEFINITIONS_DIRECTORY_PATH, DEFINITION_EXTENSIONS, INDEX_FILE_PATH)
 
     if args.list:
-        print_definitions(indexed_definitions)
+        print_definitions(enumerate(definitions, 1))
 
     if args.search:
-        filtered_indexed_definitions = filter_definitions(indexed_definitions, args.search)
-        highlighted_indexed_definitions = highlight_definitions(filtered_indexed_definitions, args.search)
-        
-        print_definitions(highlighted_indexed_definitions)
+        searched_indexed_definitions = search_definitions(enumerate(definitions, 1), args.search)
+        print_definitions(searched_indexed_definitions)
 
     if args.connect:
-        try:
-            definition_path = os.path.join(*indexed_definitions[args.connect])
+        if not 1 <= args.connect <= len(definitions):
+            print('no such connection: %s' % args.connect); exit()
+
+        definition_path = os.path.join(*definitions[args.connect - 1])
 
-            process_kwargs = {'text': True}
-            
-            if args.detach:
-                process_kwargs.update({'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL})
+        process_kwargs = {'text': True}
+        
+        if args.detach:
+            process_kwargs.update({'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL})
 
-            process = subprocess.Popen(['openvpn', '--config', definition_path, '--auth-user-pass', CREDENTIALS_FILE_PATH], **process_kwargs)
+        process = subprocess.Popen(['openvpn', '--config', definition_path, '--auth-user-pass', CREDENTIALS_FILE_PATH], **process_kwargs)
 
-            if not args.detach:
-                return_code = process.wait()
-                exit(return_code)    
+        if not args.detach:
+            return_code = process.wait()
+            exit(return_code)
 
-        except KeyError:
-            print('no such connection: %s' % args.connect); exit()